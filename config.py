@@ -8,3 +8,7 @@ DB_PATH = os.path.join("db", DB_NAME)
 DB_URL = f"sqlite:///{DB_PATH}"
 
 STOP_WORDS_PATH = "spacy_large_stopwords_ru.txt"
+
+LEMMATIZED_CACHE_SIZE = 256  # documents whose lemmatised tokens are kept in memory across reruns
+NLP_WORKERS = 8  # threads for per-file hashing, counting and compression
+LEMMA_CACHE_SIZE = 200_000  # word forms whose Mystem lemma is remembered in-process
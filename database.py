@@ -3,18 +3,25 @@ SQLite-backed documents-corpus for the Streamlit TF-IDF demo.
 
 - Three tables only: documents, lemmas, bridge table.
 - SQLAlchemy Core, not ORM: clearer SQL.
-- Compressed blobs – original text gzipped (lzma) to save space.
-- Hash-index – xxhash64 keeps duplicates out faster.
+- Compressed blobs – original text zstd-compressed to save space.
+- Hash-index – 64-bit xxHash (XXH3) keeps duplicates out faster.
+- Packed count vector per document – a single row read instead of N bridge rows.
+- Integer counts only – TF is count / lemmas_total, derived on read.
 
 """
 
 import math
 import os
-from typing import Dict, List
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
+import xxhash
 from sqlalchemy import (create_engine, MetaData, Table, Column, Integer, BigInteger,
-                        LargeBinary, String, ForeignKey, Engine, Float, insert, select, delete, func)
+                        LargeBinary, String, ForeignKey, Engine, Float, DDL, cast, insert, update, select, delete, func,
+                        event, inspect)
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from config import DB_DIR, DB_PATH, DB_URL
 from nlp import NlpDocContext
@@ -23,16 +30,44 @@ from nlp import NlpDocContext
 # --------------------------------------------------------------------------------------
 # 0. Engine setup ----------------------------------------------------------------------
 # --------------------------------------------------------------------------------------
+# Per-connection tuning: WAL + relaxed fsync instead of rollback journal with synchronous=FULL
+SQLITE_PRAGMAS = ("foreign_keys=ON",  # off by default in SQLite; ON DELETE CASCADE relies on it
+                  "journal_mode=WAL",
+                  "synchronous=NORMAL",
+                  "temp_store=MEMORY",
+                  "cache_size=-65536",  # negative means KiB -> 64 MiB page cache
+                  "mmap_size=268435456")  # 256 MiB
+
+
+def _on_connect(dbapi_connection, connection_record) -> None:
+    """`connect` event hook – runs once for every new DBAPI connection."""
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+
+    # ln() is used for IDF in SQL, but SQLite math functions are a compile-time option
+    try:
+        cursor.execute("SELECT ln(1)")
+    except sqlite3.OperationalError:
+        dbapi_connection.create_function("ln", 1, math.log, deterministic=True)
+    cursor.close()
+
+
 def setup_database(use_existing: bool = True) -> Engine:
     """Create (or reuse) the SQLite file and hand back a SQLAlchemy *Engine*."""
     if not os.path.exists(DB_DIR):
         os.makedirs(DB_DIR)
 
-    if not use_existing and os.path.exists(DB_PATH):
-        os.remove(DB_PATH)  # drop + recreate DB
+    if not use_existing:
+        # drop + recreate DB; stale WAL sidecars must go too, or they get replayed into the new file
+        for path in (DB_PATH, f"{DB_PATH}-wal", f"{DB_PATH}-shm"):
+            if os.path.exists(path):
+                os.remove(path)
 
     # Create the SQLAlchemy engine
-    engine = create_engine(DB_URL, echo=False, future=True)
+    engine = create_engine(DB_URL, echo=False, future=True,
+                           poolclass=QueuePool, pool_size=1, max_overflow=4)
+    event.listen(engine, "connect", _on_connect)
     return engine
 
 
@@ -42,68 +77,154 @@ def setup_database(use_existing: bool = True) -> Engine:
 
 metadata = MetaData()
 
+# Stamped into `PRAGMA user_version`; bump on any change to tables, blob layouts or stored hashes
+SCHEMA_VERSION = 1
+
+# 64-bit everywhere; on SQLite spelled INTEGER so that the primary key stays a rowid alias
+LemmaId = BigInteger().with_variant(Integer, "sqlite")
+
 documents = Table("documents", metadata,
                   Column("doc_id", Integer, primary_key=True, autoincrement=True),
-                  Column("xxhash64", BigInteger, nullable=False, index=True),
-                  Column("compressed_text", LargeBinary, nullable=False))
+                  Column("xxhash64", LargeBinary(8), nullable=False, index=True),  # see nlp.hash_bytes()
+                  Column("compressed_text", LargeBinary, nullable=False),
+                  Column("lemmas_total", Integer, nullable=False),  # lemmas in the doc: TF denominator
+                  Column("doc_term_vec", LargeBinary, nullable=False))  # see pack_term_vec()
 
 lemmas = Table("lemmas", metadata,
-               Column("lemma_id", Integer, primary_key=True, autoincrement=True),
-               Column("lemma", String, unique=True, nullable=False))
+               Column("lemma_id", LemmaId, primary_key=True, autoincrement=False),  # see lemma_hash_id()
+               Column("lemma", String, unique=True, nullable=False),
+               Column("doc_count", Integer, nullable=False, server_default="0"))  # denormalized: docs containing lemma
 
 documents_lemmas = Table("documents_lemmas", metadata,
                          Column("doc_id", Integer, ForeignKey("documents.doc_id", ondelete="CASCADE"), primary_key=True),
-                         Column("lemma_id", Integer, ForeignKey("lemmas.lemma_id", ondelete="CASCADE"), primary_key=True),
-                         Column("lemma_count", Integer, nullable=False),
-                         Column("lemma_tf", Float, nullable=False))  # Float is equivalent to FLOAT UNSIGNED, both 4 bytes
+                         Column("lemma_id", LemmaId, ForeignKey("lemmas.lemma_id", ondelete="CASCADE"), primary_key=True),
+                         Column("lemma_count", Integer, nullable=False),  # TF = lemma_count / documents.lemmas_total
+                         # rows live right in the (doc_id, lemma_id) PK b-tree: no hidden rowid, no second tree,
+                         # and per-doc lookups (`WHERE doc_id = ?`) are covered without any extra index
+                         sqlite_with_rowid=False)
+
+
+def lemma_hash_id(lemma: str) -> int:
+    """`lemmas.lemma_id` is derived from the lemma itself: lower 63 bits of xxhash64 (SQLite INTEGER is signed).
+
+    Collisions are negligible below ~100K distinct lemmas. Colliding lemmas share one row: `lemmas` keeps
+    the name stored first, and their counts in a document are added up (see `_counts_by_id()`).
+    """
+    return xxhash.xxh64_intdigest(lemma.encode()) & (2 ** 63 - 1)
+
+
+def _counts_by_id(lemmas_count: Dict[str, int], lemmas_map: Dict[str, int]) -> Dict[int, int]:
+    """`{lemma_id: count}` of a document; lemmas that collide on one lemma_id are merged into one count."""
+    counts_by_id = dict(zip(map(lemmas_map.__getitem__, lemmas_count.keys()), lemmas_count.values()))
+    if len(counts_by_id) < len(lemmas_count):  # a collision inside this doc – rare, redo with summing
+        counts_by_id = {}
+        for lemma, lemma_count in lemmas_count.items():
+            lemma_id = lemmas_map[lemma]
+            counts_by_id[lemma_id] = counts_by_id.get(lemma_id, 0) + lemma_count
+    return counts_by_id
+
+
+def pack_term_vec(lemma_ids: Iterable[int], counts: Iterable[int]) -> bytes:
+    """Per-doc count vector as one blob: int64 lemma_ids (ascending) followed by int32 counts of equal length."""
+    ids_arr = np.fromiter(lemma_ids, dtype=np.int64)
+    counts_arr = np.fromiter(counts, dtype=np.int32, count=len(ids_arr))
+    order = np.argsort(ids_arr)
+    return ids_arr[order].tobytes() + counts_arr[order].tobytes()
+
+
+def unpack_term_vec(blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """Inverse of pack_term_vec() – zero-copy views `(lemma_ids, counts)` over the blob."""
+    n = len(blob) // 12  # 8 bytes of id + 4 bytes of count per lemma
+    return np.frombuffer(blob, dtype=np.int64, count=n), np.frombuffer(blob, dtype=np.int32, offset=8 * n)
+
+
+# Keep `lemmas.doc_count` in sync when associations go away (incl. ON DELETE CASCADE from `documents`);
+# the increment side is done in bulk by `Corpus.add_documents`
+event.listen(documents_lemmas, "after_create",
+             DDL("CREATE TRIGGER IF NOT EXISTS documents_lemmas_doc_count_dec "
+                 "AFTER DELETE ON documents_lemmas FOR EACH ROW BEGIN "
+                 "UPDATE lemmas SET doc_count = doc_count - 1 WHERE lemma_id = OLD.lemma_id; "
+                 "END"))
 
 
 # --------------------------------------------------------------------------------------
 # 2. Public interface ------------------------------------------------------------------
 # --------------------------------------------------------------------------------------
+class IncompatibleDatabaseError(RuntimeError):
+    """The SQLite file was written with another schema version and cannot be opened as is."""
+
+
 class Corpus:
     """Interface for the SQLite-powered text corpus using SQLAlchemy Core as DSL."""
 
     def __init__(self, engine: Engine):
         self.engine = engine
-        self.Session = sessionmaker(bind=self.engine, future=True)
-        metadata.create_all(self.engine)  # idempotent – safe on every import
+        self.Session = sessionmaker(bind=self.engine, future=True)  # short-lived, for writes only
+        with self.engine.begin() as conn:
+            user_version = conn.exec_driver_sql("PRAGMA user_version").scalar_one()
+            if user_version != SCHEMA_VERSION and inspect(conn).get_table_names():
+                raise IncompatibleDatabaseError(f"Database schema version {user_version}, "
+                                                f"this version expects {SCHEMA_VERSION}.")
+            metadata.create_all(conn)  # idempotent – safe on every import
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._ro_conn = self.engine.connect()  # long-lived, for reads: no per-call pool checkout
+        self._local_writes = 0  # see _corpus_version()
+        self._info_cache = None  # see document_lemmas_info()
 
     # ---------------------------------------------------------------- add / delete ---
     def add_document(self, nlp: NlpDocContext) -> int:
         """Puts a fully-parsed document into the three tables."""
-        if not nlp.is_full():  # quick check
+        return self.add_documents([nlp])[0]
+
+    def add_documents(self, nlps: List[NlpDocContext]) -> List[int]:
+        """Puts many fully-parsed documents into the three tables in one transaction; doc_ids in input order."""
+        if not all(nlp.is_full() for nlp in nlps):  # quick check
             raise ValueError("NlpDocContext must be filled before DB insertion.")
+        if not nlps:
+            return []
 
         with self.Session() as session:
             with session.begin():
-                # 1) Insert document to `documents`
-                res = session.execute(insert(documents)
-                                      .values(xxhash64=nlp.xxhash64,
-                                              compressed_text=nlp.compressed_text)
-                                      .returning(documents.c.doc_id))
-                doc_id = res.scalar_one()  # Get primary key of last added entry (first autoincremented doc_id)
-
-                # 2) Upsert lemmas to `lemmas` (SQLite specific OR IGNORE)
-                unique_lemmas = set(nlp.lemmas_count_map.keys())
-                for lemma in unique_lemmas:
-                    session.execute(insert(lemmas).prefix_with("OR IGNORE").values(lemma=lemma))
-
-                # 3) Fetch lemma IDs
-                rows = session.execute(select(lemmas.c.lemma_id, lemmas.c.lemma)
-                                       .where(lemmas.c.lemma.in_(unique_lemmas)))  # each row is (lemma_id, lemma)
-                lemmas_map = {row.lemma: row.lemma_id for row in rows}
-
-                # 4) Fill associations table `documents_lemmas`
+                # 1) Upsert lemmas of the whole batch to `lemmas` (SQLite specific OR IGNORE);
+                #    IDs are hashes of the lemmas, so nothing has to be read back
+                unique_lemmas = set().union(*(nlp.lemmas_count_map.keys() for nlp in nlps))
+                lemmas_map = {lemma: lemma_hash_id(lemma) for lemma in unique_lemmas}
+                lemma_rows = [{"lemma_id": lemma_id, "lemma": lemma} for lemma, lemma_id in lemmas_map.items()]
+                session.execute(insert(lemmas).prefix_with("OR IGNORE"), lemma_rows)
+                docs_counts = [_counts_by_id(nlp.lemmas_count_map, lemmas_map) for nlp in nlps]
+
+                # 2) Insert documents to `documents`, along with their packed count vectors
+                doc_rows = [{"xxhash64": nlp.xxhash64,
+                             "compressed_text": nlp.compressed_text,
+                             "lemmas_total": len(nlp.tokens_lemmatized),
+                             "doc_term_vec": pack_term_vec(counts_by_id.keys(), counts_by_id.values())}
+                            for nlp, counts_by_id in zip(nlps, docs_counts)]
+                res = session.execute(insert(documents).returning(documents.c.doc_id, sort_by_parameter_order=True),
+                                      doc_rows)
+                doc_ids = res.scalars().all()
+
+                # 3) Fill associations table `documents_lemmas`
                 doc_lemma_rows = []
-                for curr_lemma in unique_lemmas:
-                    doc_lemma_rows.append({"doc_id": doc_id,
-                                           "lemma_id": lemmas_map[curr_lemma],
-                                           "lemma_count": nlp.lemmas_count_map[curr_lemma],
-                                           "lemma_tf": nlp.lemmas_tf_map[curr_lemma]})
+                for doc_id, counts_by_id in zip(doc_ids, docs_counts):
+                    for lemma_id, lemma_count in counts_by_id.items():
+                        doc_lemma_rows.append({"doc_id": doc_id,
+                                               "lemma_id": lemma_id,
+                                               "lemma_count": lemma_count})
                 session.execute(insert(documents_lemmas), doc_lemma_rows)
 
-        return doc_id
+                # 4) Bump document frequency of every lemma by the number of new docs linked to it
+                batch_links = documents_lemmas.alias("batch_links")
+                new_links = (select(func.count())
+                             .where(batch_links.c.lemma_id == lemmas.c.lemma_id,
+                                    batch_links.c.doc_id.in_(doc_ids))
+                             .scalar_subquery())
+                linked_ids = select(documents_lemmas.c.lemma_id).where(documents_lemmas.c.doc_id.in_(doc_ids))
+                session.execute(update(lemmas)
+                                .where(lemmas.c.lemma_id.in_(linked_ids))
+                                .values(doc_count=lemmas.c.doc_count + new_links))
+
+        self._local_writes += 1
+        return doc_ids
 
     def del_document(self, doc_id: int) -> None:
         """
@@ -114,76 +235,60 @@ class Corpus:
         with self.Session() as session:
             with session.begin():
                 session.execute(delete(documents).where(documents.c.doc_id == doc_id))
+        self._local_writes += 1
 
     # ---------------------------------------------------------------- lookup -----------
-    def get_hashmap(self) -> Dict[int, int]:
+    def _fetch(self, query) -> list:
+        """Run a read-only query on the long-lived connection; no transaction is left open after it."""
+        rows = self._ro_conn.execute(query).all()
+        self._ro_conn.rollback()
+        return rows
+
+    def find_by_hash(self, xxhash64: bytes) -> Optional[int]:
+        """doc_id of a document with this content hash, if any – one probe of the `xxhash64` index."""
+        rows = self._fetch(select(documents.c.doc_id).where(documents.c.xxhash64 == xxhash64).limit(1))
+        return rows[0].doc_id if rows else None
+
+    def get_hashmap(self) -> Dict[bytes, int]:
         """Returns `{xxhash64: doc_id, ...}` snapshot – used for duplicate detection."""
-        with self.Session() as session:
-            rows = session.execute(select(documents.c.doc_id, documents.c.xxhash64)).all()
-            return {row.xxhash64: row.doc_id for row in rows} if rows else {}
+        rows = self._fetch(select(documents.c.doc_id, documents.c.xxhash64))
+        return {row.xxhash64: row.doc_id for row in rows} if rows else {}
 
     def lemmas_id_doccount_map(self):
-        """For IDF: how many docs contain each lemma."""
-        with (self.Session() as session):
-            with session.begin():
-                # Group by `lemma_id` -> arrgegate by count unique `doc_id`s
-                query = select(
-                    documents_lemmas.c.lemma_id,
-                    # arrgegate by count `doc_id`s
-                    func.count(func.distinct(documents_lemmas.c.doc_id)).label('doc_count')
-                ).group_by(documents_lemmas.c.lemma_id)
+        """For IDF: how many docs contain each lemma (maintained on write, no aggregation here)."""
+        query = select(lemmas.c.lemma_id, lemmas.c.doc_count).where(lemmas.c.doc_count > 0)
 
-                rows = session.execute(query).all()
-                return {row.lemma_id: row.doc_count for row in rows}
+        rows = self._fetch(query)
+        return {row.lemma_id: row.doc_count for row in rows}
 
     def lemmas_count(self, doc_id: int) -> Dict[int, int]:
         """Lemmas' counts for a given doc."""
-        with self.Session() as session:
-            with session.begin():
-                query = select(
-                    documents_lemmas.c.lemma_id,
-                    documents_lemmas.c.lemma_count
-                ).where(documents_lemmas.c.doc_id == doc_id)
+        query = select(
+            documents_lemmas.c.lemma_id,
+            documents_lemmas.c.lemma_count
+        ).where(documents_lemmas.c.doc_id == doc_id)
 
-                rows = session.execute(query).all()
-                return {row.lemma_id: row.lemma_count for row in rows}
+        rows = self._fetch(query)
+        return {row.lemma_id: row.lemma_count for row in rows}
 
     def lemmas_tf(self, doc_id: int) -> Dict[int, float]:
-        """Pre-computed term frequency map."""
-        with (self.Session() as session):
-            with session.begin():
-                query = select(documents_lemmas.c.lemma_id, documents_lemmas.c.lemma_tf
-                               ).where(documents_lemmas.c.doc_id == doc_id)
-
-                rows = session.execute(query).all()
-                return {row.lemma_id: row.lemma_tf for row in rows}
+        """Term frequency map – one row read, derived from the counts in `documents.doc_term_vec`."""
+        rows = self._fetch(select(documents.c.doc_term_vec, documents.c.lemmas_total)
+                           .where(documents.c.doc_id == doc_id))
+        if not rows:
+            return {}
 
-    # ---------------------------------------------------------------- TF-IDF -----------
-    def lemma_tfidf_map(self, doc_id: int) -> Dict[int, float]:
-        """TF-IDF per lemma for doc_id."""
-        with self.Session() as session:
-            with session.begin():
-                query = select(func.count()).select_from(documents)
-                total_docs = session.execute(query).scalar_one()
-                if total_docs == 0:  # empty corpus – nothing to do
-                    return {}
+        lemma_ids, counts = unpack_term_vec(rows[0].doc_term_vec)
+        return dict(zip(lemma_ids.tolist(), (counts / rows[0].lemmas_total).tolist()))
 
-                tf_map = self.lemmas_tf(doc_id)
-                if not tf_map:
-                    raise RuntimeError(f"document {doc_id=} has no lemmas (should never happen ??!)")
-
-                lemid_doccount_map = self.lemmas_id_doccount_map()
-
-                tf_idf_result: Dict[int, float] = {}
-                for lemma_id, tf in tf_map.items():
-                    doccount = lemid_doccount_map.get(lemma_id) or 0
-                    if doccount == 0:
-                        continue  # ownerless lemma encoutered - infinite IDF case skipped
-
-                    idf = math.log(total_docs / doccount)
-                    tf_idf_result[lemma_id] = tf * idf
-
-                return tf_idf_result
+    def _corpus_version(self) -> Tuple[int, int]:
+        """
+        Changes whenever the corpus may have changed: SQLite's `data_version` reports commits from any
+        other connection (e.g. another Streamlit session), the counter covers writes of this Corpus.
+        """
+        data_version = self._ro_conn.exec_driver_sql("PRAGMA data_version").scalar_one()
+        self._ro_conn.rollback()
+        return data_version, self._local_writes
 
     # ---------------------------------------------------------------- output ----------
     def document_lemmas_info(self, doc_id: int) -> List[dict]:
@@ -191,42 +296,39 @@ class Corpus:
 
         lemma_stat = {'lemma': str, 'count': int, 'tf': float, 'idf': float, 'tf-idf': float}
         Sorted descending by 'tf-idf'.
+
+        The last result is kept while `_corpus_version()` is unchanged, so Streamlit reruns for the same doc
+        cost one `PRAGMA data_version`. Shared between calls – do not mutate.
         """
-        with self.Session() as session:
-            with session.begin():
-                # Total documents
-                total_docs = session.execute(select(func.count()).select_from(documents)).scalar_one()
-                if total_docs == 0:
-                    return []
-
-                # Load known info
-                tf_map = self.lemmas_tf(doc_id)
-                count_map = self.lemmas_count(doc_id)
-                tfidf_map = self.lemma_tfidf_map(doc_id)
-                lemid_doccount_map = self.lemmas_id_doccount_map()
-
-                # Resolve lemma_id -> lemma
-                lemma_ids = list(count_map.keys())
-                rows = session.execute(select(lemmas.c.lemma_id, lemmas.c.lemma)
-                                       .where(lemmas.c.lemma_id.in_(lemma_ids))).fetchall()
-                id_to_lemma = {row.lemma_id: row.lemma for row in rows}
-
-                # Compose list of stats
-                data: List[dict] = []
-                for lemma_id in lemma_ids:
-                    # Assemble one dict per lemma
-                    lemma = id_to_lemma.get(lemma_id, f"[id={lemma_id}]")
-                    count = count_map.get(lemma_id, 0)
-                    tf = tf_map.get(lemma_id, 0.0)
-                    docs_count = lemid_doccount_map.get(lemma_id, 1)
-                    idf = math.log(total_docs / docs_count) if docs_count else 0.0  # idf of lemma iside Corpus
-                    tfidf = tfidf_map.get(lemma_id, 0.0)
-
-                    data.append({"word": lemma,
-                                 "count": count,
-                                 "tf": tf,
-                                 "idf": idf,
-                                 "tf-idf": tfidf})
-
-                # Pre-sort by tf-idf descending
-                return sorted(data, key=lambda x: x["tf-idf"], reverse=True)
+        version = self._corpus_version()
+        if self._info_cache is not None and self._info_cache[:2] == (doc_id, version):
+            return self._info_cache[2]
+
+        # Total documents
+        total_docs = self._fetch(select(func.count()).select_from(documents))[0][0]
+        if total_docs == 0:
+            return []
+
+        # One pass: lemma text, its count and tf in this doc, idf and tf-idf – already sorted by SQLite
+        tf = cast(documents_lemmas.c.lemma_count, Float) / documents.c.lemmas_total
+        idf = func.ln(float(total_docs) / lemmas.c.doc_count)
+        tfidf = (tf * idf).label("tfidf")
+        query = (select(lemmas.c.lemma,
+                        documents_lemmas.c.lemma_count,
+                        tf.label("tf"),
+                        idf.label("idf"),
+                        tfidf)
+                 .join_from(documents_lemmas, lemmas, documents_lemmas.c.lemma_id == lemmas.c.lemma_id)
+                 .join(documents, documents.c.doc_id == documents_lemmas.c.doc_id)
+                 .where(documents_lemmas.c.doc_id == doc_id)
+                 .order_by(tfidf.desc()))
+
+        # Compose list of stats, one dict per lemma
+        lemmas_info = [{"word": row.lemma,
+                        "count": row.lemma_count,
+                        "tf": row.tf,
+                        "idf": row.idf,
+                        "tf-idf": row.tfidf}
+                       for row in self._fetch(query)]
+        self._info_cache = (doc_id, version, lemmas_info)
+        return lemmas_info
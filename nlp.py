@@ -3,31 +3,63 @@ NLP toolkit.
 
 - Cyrillic tokeniser + stop-list
 - Lemmas via pymystem3
-- xxhash64 for duplicate detection
-- LZMA compression for raw text
+- Counts via NumPy (TF = count / total is derived on read)
+- 64-bit xxHash (XXH3) for duplicate detection
+- zstd compression for raw text
 
 """
 
-import lzma
 import re
-from collections import Counter
-from dataclasses import dataclass
-from typing import Optional
-
+import threading
+from collections import deque
+from dataclasses import dataclass, fields
+from functools import cache
+from itertools import chain, count
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
 import xxhash
-from pymystem3 import Mystem
+import zstandard
+
+from config import LEMMA_CACHE_SIZE, STOP_WORDS_PATH
 
-from config import STOP_WORDS_PATH
+if TYPE_CHECKING:
+    from pymystem3 import Mystem
 
 # ---------------------------------------------------------------------------
 # 0. One-time resources
 # ---------------------------------------------------------------------------
 
-with open(STOP_WORDS_PATH, encoding="utf-8") as f:
-    stop_words_set = {w.strip() for w in f if w.strip()}
+re_russian_word = re.compile(r"\b[а-яА-ЯёЁ]++\b")  # possessive: no backtracking on words glued to digits/latin
+# word form -> lemma (None: Mystem gave no usable lemma), filled from past Mystem answers; insertion-ordered
+_lemma_cache: dict[str, Optional[str]] = {}
+_lemma_cache_lock = threading.Lock()  # the cache is shared by every Streamlit session thread
+_mystem_lock = threading.Lock()  # one Mystem pipe for all sessions: creation and every analyze() go through it
+_thread_local = threading.local()  # per-thread zstd context: ZstdCompressor must not be shared between threads
+
+
+@cache
+def get_stop_words() -> frozenset[str]:
+    """The stop-list, read from disk on first use only; later calls and Streamlit reruns share it."""
+    # Lower-cased at load: tokens are lower-cased in bulk once per text, never per token
+    with open(STOP_WORDS_PATH, encoding="utf-8") as f:
+        return frozenset(w.strip().lower() for w in f if w.strip())
 
-re_russian_word = re.compile(r"\b[а-яА-ЯёЁ]+\b")
-mystem = Mystem()
+
+@cache
+def get_mystem() -> "Mystem":
+    """
+    The process-wide Mystem, created on first lemmatisation.
+
+    Module import stays cheap (pymystem3 is imported here, and Mystem() may download its binary);
+    later calls and Streamlit reruns reuse the same object and with it pymystem3's running subprocess.
+    Call and use it under `_mystem_lock`: neither `cache` nor the subprocess pipe is thread-safe.
+    """
+    from pymystem3 import Mystem
+
+    # Only lemmas are used: no grammar tags, no weights, no echo of non-words, and no disambiguation
+    # (distinct word forms are sent without context anyway, see _lemmatize)
+    return Mystem(grammar_info=False, disambiguation=False, entire_input=False, weight=False)
 
 
 # ---------------------------------------------------------------------------
@@ -40,23 +72,44 @@ class NlpDocContext:
     """Mutable carrier for every artefact produced during parsing."""
 
     text_input: str
-    xxhash64: Optional[int] = None
+    encoded_bytes: Optional[bytes] = None  # UTF-8 of text_input, shared by hashing and compression
+    xxhash64: Optional[bytes] = None
     compressed_text: Optional[bytes] = None
     tokens_lemmatized: Optional[list[str]] = None
     lemmas_count_map: Optional[dict[str, int]] = None
-    lemmas_tf_map: Optional[dict[str, float]] = None
 
     def clear(self) -> None:
         """Drop all data to help garbaje collector."""
-        for field_name in self.__annotations__:
+        for field_name in _NLP_FIELDS:
             object.__setattr__(self, field_name, None)
 
     def is_full(self) -> bool:
         """Checks that every field is set."""
-        for field_name in self.__annotations__:
-            if getattr(self, field_name) is None:
-                return False
-        return True
+        return all(getattr(self, field_name) is not None for field_name in _NLP_FIELDS)
+
+    @classmethod
+    def acquire(cls, text_input: str, **artefacts) -> "NlpDocContext":
+        """Take a released context from the pool (or make a new one) and fill it like the constructor does."""
+        if not artefacts.keys() <= _NLP_FIELDS_SET:
+            return cls(text_input, **artefacts)  # the constructor reports unknown fields; the pool is left intact
+        try:
+            nlp = _NLP_POOL.pop()
+        except IndexError:
+            return cls(text_input, **artefacts)
+        nlp.text_input = text_input
+        for field_name, value in artefacts.items():
+            setattr(nlp, field_name, value)
+        return nlp
+
+    def release(self) -> None:
+        """Clear and hand back to the pool. The context must not be used afterwards."""
+        self.clear()
+        _NLP_POOL.append(self)
+
+
+_NLP_FIELDS = tuple(f.name for f in fields(NlpDocContext))  # resolved once, not per call
+_NLP_FIELDS_SET = frozenset(_NLP_FIELDS)
+_NLP_POOL: deque[NlpDocContext] = deque(maxlen=64)  # released contexts; bounded so a huge upload is not kept
 
 
 # ---------------------------------------------------------------------------
@@ -64,17 +117,33 @@ class NlpDocContext:
 # ---------------------------------------------------------------------------
 
 
-def hash_original_text(nlp: NlpDocContext) -> Optional[int]:
-    """"
-    Store 63-bit xxhash64 inside nlp.
+def _encoded(nlp: NlpDocContext) -> bytes:
+    """UTF-8 bytes of the raw text, encoded on first use only."""
+    if nlp.encoded_bytes is None:
+        nlp.encoded_bytes = nlp.text_input.encode()
+    return nlp.encoded_bytes
+
 
-    It is clear workaround of SQLite limitation on BigInteger.
-    Applicable for text-corpus volume less than 100K documents.
+def hash_bytes(raw: bytes) -> bytes:
     """
-    nlp.xxhash64 = xxhash.xxh64(nlp.text_input.encode()).intdigest() & (2 ** 63 - 1)  # keep only lower 63 bits
+    64-bit xxHash (XXH3) digest (8 raw bytes) of UTF-8 content, no decoding needed.
+
+    Kept as bytes, not int: SQLite BIGINT is signed and could not hold the top bit.
+    """
+    return xxhash.xxh3_64(raw).digest()
+
+
+def hash_original_text(nlp: NlpDocContext) -> Optional[bytes]:
+    """Store 64-bit xxHash digest of the raw text inside nlp."""
+    nlp.xxhash64 = hash_bytes(_encoded(nlp))
     return nlp.xxhash64 or None
 
 
+def has_russian_words(text: str) -> bool:
+    """Cheap pre-check: stops at the first Cyrillic word, so only texts without any are scanned in full."""
+    return re_russian_word.search(text) is not None
+
+
 def tokenize(nlp: NlpDocContext, text: str = "") -> Optional[list[str]]:
     """Lemmatise text and filter stop-words."""
     if not nlp.text_input and not text:
@@ -86,29 +155,85 @@ def tokenize(nlp: NlpDocContext, text: str = "") -> Optional[list[str]]:
     else:
         raise ValueError("The 'text' argument given, but 'nlp.text_input' is not empty.")
 
-    tokens_iterator = re_russian_word.finditer(text)
-    tokens = [match.group() for match in tokens_iterator
-              if match.group().lower() not in stop_words_set]
-    lemmas = mystem.lemmatize(" ".join(tokens))
-    # filter lemmatized tokens to ensure 'words contained letters only'
-    tokens_lemmatized = [t.strip() for t in lemmas if t.strip().isalpha()]
+    nlp.tokens_lemmatized = _lemmatize([_scan_tokens(text)])[0]
+    return nlp.tokens_lemmatized or None
+
+
+def tokenize_many(nlps: list[NlpDocContext]) -> list[Optional[list[str]]]:
+    """Same as tokenize() for several documents, with a single Mystem round-trip for all of them."""
+    if not all(nlp.text_input for nlp in nlps):
+        raise ValueError("Every 'nlp.text_input' must be filled.")
 
-    nlp.tokens_lemmatized = tokens_lemmatized
-    return tokens_lemmatized or None
+    batch = _lemmatize([_scan_tokens(nlp.text_input) for nlp in nlps])
+    for nlp, tokens_lemmatized in zip(nlps, batch):
+        nlp.tokens_lemmatized = tokens_lemmatized
+    return [tokens_lemmatized or None for tokens_lemmatized in batch]
 
 
-def compute_count_tf(nlp: NlpDocContext) -> tuple[Optional[dict[str, int]], Optional[dict[str, float]]]:
-    """Populate *count* and *TF* maps for the current document."""
+def _scan_tokens(text: str) -> list[str]:
+    """Lower-case once, scan Cyrillic words in C. Stop-words are dropped later, per distinct form."""
+    return re_russian_word.findall(text.lower())
+
+
+def _lemmatize(token_lists: list[list[str]]) -> list[list[str]]:
+    """
+    Lemmatise many token streams with at most one Mystem call.
+
+    Distinct word forms missing from `_lemma_cache` go to Mystem as one line (one pymystem3 round-trip)
+    and are mapped back by the `text` Mystem echoes. Stop-words are never sent, so `lemma_of` drops them.
+    """
+    stop_words = get_stop_words()
+    word_forms = dict.fromkeys(chain.from_iterable(token_lists))
+    # This call's own view of the lemmas: other threads may evict from the shared cache meanwhile
+    with _lemma_cache_lock:
+        lemma_of = {w: _lemma_cache[w] for w in word_forms if w in _lemma_cache}
+    unknown = [w for w in word_forms if w not in lemma_of and w not in stop_words]
+    if unknown:
+        answers: dict[str, Optional[str]] = {}
+        with _mystem_lock:  # the cache and its snapshot above stay outside: other sessions are not held up
+            analyzed = get_mystem().analyze(" ".join(unknown))
+        for item in analyzed:
+            if "analysis" not in item:
+                continue  # not a word
+            lemma = item["analysis"][0]["lex"] if item["analysis"] else item["text"]
+            # filter lemmatized tokens to ensure 'words contained letters only'
+            answers[item["text"]] = lemma if lemma.isalpha() else None
+        lemma_of.update(answers)
+
+        with _lemma_cache_lock:
+            _lemma_cache.update(answers)
+            while len(_lemma_cache) > LEMMA_CACHE_SIZE:  # oldest forms go first
+                _lemma_cache.pop(next(iter(_lemma_cache)), None)
+
+    # filter(None, ...) drops forms without a usable lemma and stop-words (both give None)
+    return [list(filter(None, map(lemma_of.get, tokens))) for tokens in token_lists]
+
+
+def compute_counts(nlp: NlpDocContext) -> Optional[dict[str, int]]:
+    """Populate the *count* map for the current document. TF is count / len(tokens_lemmatized)."""
     assert nlp.tokens_lemmatized, "Run tokenize() first."
 
-    nlp.lemmas_count_map = Counter(nlp.tokens_lemmatized)  # dict {'token1': <token1_count>, ...}
-    total = sum(nlp.lemmas_count_map.values())
+    # Intern lemmas to int codes once, then count in NumPy instead of a per-lemma Python loop;
+    # codes and ids are built by C-level iterators (dict.fromkeys/zip/map), no bytecode runs per token
+    codes = dict(zip(dict.fromkeys(nlp.tokens_lemmatized), count()))
+    ids = np.fromiter(map(codes.__getitem__, nlp.tokens_lemmatized),
+                      dtype=np.int32, count=len(nlp.tokens_lemmatized))
+    counts = np.bincount(ids, minlength=len(codes))  # counts[code] = occurrences of lemma with that code
+
+    # dict keeps insertion order -> codes' keys line up with counts
+    nlp.lemmas_count_map = dict(zip(codes, counts.tolist()))  # dict {'token1': <token1_count>, ...}
+    return nlp.lemmas_count_map or None
+
 
-    nlp.lemmas_tf_map = {word: count / total for word, count in nlp.lemmas_count_map.items()}
-    return nlp.lemmas_count_map or None, nlp.lemmas_tf_map or None
+def _zstd_compressor() -> zstandard.ZstdCompressor:
+    """Compressor of the calling thread, reused between calls: no per-call encoder setup."""
+    compressor = getattr(_thread_local, "zstd_compressor", None)
+    if compressor is None:
+        compressor = _thread_local.zstd_compressor = zstandard.ZstdCompressor(level=3)
+    return compressor
 
 
 def compress_original_text(nlp: NlpDocContext) -> Optional[bytes]:
-    """LZMA-compress raw text."""
-    nlp.compressed_text = lzma.compress(nlp.text_input.encode())
+    """zstd-compress raw text. Safe to call from worker threads."""
+    nlp.compressed_text = _zstd_compressor().compress(_encoded(nlp))
     return nlp.compressed_text or None
@@ -10,12 +10,17 @@ Running at `http://localhost:8501`
 
 """
 
-import pandas as pd
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+import numpy as np
 import streamlit as st
 
-from database import setup_database, Corpus
+from config import LEMMATIZED_CACHE_SIZE, NLP_WORKERS
+from database import setup_database, Corpus, IncompatibleDatabaseError
 from logger import info
-from nlp import NlpDocContext, hash_original_text, tokenize, compute_count_tf, compress_original_text
+from nlp import NlpDocContext, hash_bytes, has_russian_words, tokenize_many, compute_counts, compress_original_text
 
 # --------------------------------------------------------------------------------------
 # 0. Boostrapping: choose or (re)create the database -----------------------------------
@@ -29,7 +34,6 @@ if 'db_ready' not in st.session_state:
     if st.button("Подтвердить выбор базы данных"):
         st.session_state.db_ready = True
         st.session_state.use_existing_db = (choice == "Использовать существующую базу")
-        st.session_state.hashmap = {}  # {xxhash64: doc_id}
         st.rerun()
     else:
         st.warning("Надо выбрать пункт")
@@ -45,14 +49,20 @@ if 'engine' not in st.session_state:
 engine = st.session_state.engine
 
 if 'corpus' not in st.session_state:
-    st.session_state.corpus = Corpus(engine)
+    try:
+        st.session_state.corpus = Corpus(engine)
+    except IncompatibleDatabaseError as exc:
+        # Written by an older version of the app: tables and hashes do not match, nothing to reuse
+        st.error(f"Существующая база создана другой версией приложения и не может быть открыта: {exc} "
+                 f"Выберите пункт «Создать новую базу».")
+        if st.button("Вернуться к выбору базы данных"):
+            engine.dispose()
+            for key in ("db_ready", "use_existing_db", "engine"):
+                del st.session_state[key]
+            st.rerun()
+        st.stop()
 corpus = st.session_state.corpus
 
-if 'hashmap' not in st.session_state:
-    # Speed-up duplicate detection: {xxhash64: doc_id}
-    st.session_state.hashmap = corpus.get_hashmap()
-hashmap = st.session_state.hashmap
-
 # Streamlit re-uses widget keys between reruns, so we bump a counter to
 # force the uploader to be recreated – otherwise stale files linger.
 if 'uploader_round' not in st.session_state:
@@ -63,6 +73,30 @@ if 'uploaded_files_info' not in st.session_state:
     st.session_state.uploaded_files_info = []  # [{filename, doc_id, hash}]
     st.session_state.last_uploaded = None  # (filename, doc_id)
 
+# --------------------------------------------------------------------------------------
+# 1b. Process-wide resources – shared by every session, survive reruns -----------------
+# --------------------------------------------------------------------------------------
+
+@st.cache_resource
+def lemmatized_cache() -> tuple[dict[bytes, list[str]], threading.Lock]:
+    """Process-wide xxhash64 -> tokens_lemmatized, so re-uploaded contents skip Mystem. Use under the lock."""
+    return {}, threading.Lock()  # insertion-ordered: the oldest entry is evicted first
+
+
+@st.cache_resource
+def worker_pool() -> ThreadPoolExecutor:
+    """Process-wide threads for per-document counting and compression; zstd releases the GIL while compressing."""
+    return ThreadPoolExecutor(max_workers=NLP_WORKERS, thread_name_prefix="nlp")
+
+
+def count_and_compress(doc_cxt: NlpDocContext) -> bool:
+    """Per-document CPU stages, run in worker_pool(). False when counting gave nothing."""
+    if compute_counts(doc_cxt) is None:
+        return False
+    compress_original_text(doc_cxt)
+    return True
+
+
 # --------------------------------------------------------------------------------------
 # 2. File upload form ------------------------------------------------------------------
 # --------------------------------------------------------------------------------------
@@ -82,57 +116,97 @@ with st.form(key="upload_form"):
 # --------------------------------------------------------------------------------------
 
 if submit and files:
-    documents_loaded: list[int] = []
-    last_filename = ""
-    last_doc_id: int | None = None
-
-    for f in files:
-        file_contents = f.read().decode("utf-8")
-        if not file_contents:
-            continue  # empty file – skip silently
-
-        # -------- NLP pipeline (single document) --------------------------------------
-
-        doc_cxt = NlpDocContext(file_contents)
-        try:
-
-            xxhash64 = hash_original_text(doc_cxt)
-            if xxhash64 in hashmap:
-                # Exact duplicate – no need to parse once more
-                doc_id = hashmap[xxhash64]
-                st.info(f"File {f.name} has same content as existing document doc_id={doc_id}.")
-                documents_loaded.append(doc_id)
-                last_filename, last_doc_id = f.name, doc_id
+    uploads: list[tuple[str, bytes]] = []  # (filename, xxhash64) in upload order
+    stored: dict[bytes, int] = {}  # xxhash64 -> doc_id of every content that is in the database
+    to_parse: dict[bytes, tuple[str, NlpDocContext]] = {}  # new contents, first filename of each
+
+    # -------- Pass 1: hash + duplicate check, no NLP yet -----------------------------
+
+    # UploadedFile is a BytesIO over the upload: a whole read() from position 0 hands back that very bytes
+    # object, no copy (getbuffer() would copy – it has to unshare the buffer before exposing it writable)
+    raws = [(f.name, raw) for f in files if (raw := f.read())]  # empty file – skip silently
+    # Duplicate check goes first, on raw bytes – one index probe instead of decoding and the NLP pipeline
+    xxhashes = map(hash_bytes, (raw for _, raw in raws))  # inline: xxh3 is far quicker than a thread hand-off
+
+    for (filename, raw), xxhash64 in zip(raws, xxhashes):
+        uploads.append((filename, xxhash64))
+        if xxhash64 in stored or xxhash64 in to_parse:
+            continue  # same content twice in one upload
+
+        doc_id = corpus.find_by_hash(xxhash64)
+        if doc_id is not None:
+            # Exact duplicate – no need to parse once more
+            st.info(f"File {filename} has same content as existing document doc_id={doc_id}.")
+            stored[xxhash64] = doc_id
+            continue
+
+        # New content only: decode, and keep the raw bytes for compression
+        file_contents = raw.decode("utf-8")
+        if not has_russian_words(file_contents):
+            # Nothing for Mystem to lemmatise – drop before any NLP context is built
+            st.warning(f"File {filename} has no valid tokens. To drop.")
+            continue
+
+        to_parse[xxhash64] = (filename, NlpDocContext.acquire(file_contents, encoded_bytes=raw, xxhash64=xxhash64))
+
+    # -------- Pass 2: NLP pipeline, one Mystem round-trip for all new documents -----
+
+    try:
+        # Contents lemmatised before (deleted doc, recreated database, another session) come from the cache
+        cache, cache_lock = lemmatized_cache()
+        cold = []
+        with cache_lock:
+            for xxhash64, (_, doc_cxt) in to_parse.items():
+                tokens_lemmatized = cache.get(xxhash64)
+                if tokens_lemmatized is None:
+                    cold.append(doc_cxt)
+                else:
+                    doc_cxt.tokens_lemmatized = tokens_lemmatized
+
+        if cold:
+            tokenize_many(cold)  # outside the lock: other sessions keep using the cache meanwhile
+            with cache_lock:
+                for doc_cxt in cold:
+                    cache[doc_cxt.xxhash64] = doc_cxt.tokens_lemmatized
+                while len(cache) > LEMMATIZED_CACHE_SIZE:
+                    cache.pop(next(iter(cache)), None)
+
+        parsed: list[tuple[bytes, str, NlpDocContext]] = []
+        for xxhash64, (filename, doc_cxt) in to_parse.items():
+            if not doc_cxt.tokens_lemmatized:
+                st.warning(f"File {filename} has no valid tokens. To drop.")
                 continue
-
-            tokens = tokenize(doc_cxt)
-            if not tokens:
-                st.warning(f"File {f.name} has no valid tokens. To drop.")
+            parsed.append((xxhash64, filename, doc_cxt))
+
+        # Counting and compression in worker threads; Streamlit calls and the DB write stay on this one
+        results = worker_pool().map(count_and_compress, [doc_cxt for _, _, doc_cxt in parsed])
+        ready: list[tuple[bytes, str, NlpDocContext]] = []  # parsed documents waiting for the single DB write
+        for (xxhash64, filename, doc_cxt), ok in zip(parsed, results):
+            if not ok:
+                st.error(f"File {filename} gives incorrect results during analysis. To drop.")
                 continue
+            ready.append((xxhash64, filename, doc_cxt))
 
-            lemmas_count_map, lemmas_tf_map = compute_count_tf(doc_cxt)
-            if lemmas_count_map is None or lemmas_tf_map is None:
-                st.error(f"File {f.name} gives incorrect results during analysis. To drop.")
-                continue
+        # -------- Commit all new documents to database, one transaction -------------
 
-            compress_original_text(doc_cxt)
+        doc_ids = corpus.add_documents([doc_cxt for _, _, doc_cxt in ready])
+        for (xxhash64, filename, _), doc_id in zip(ready, doc_ids):
+            stored[xxhash64] = doc_id
+            info(f"File {filename} prepared and added to database with doc_id={doc_id}")
 
-            # -------- Commit document to database ------------------------------------
+    except Exception:
+        # Any unforeseen error – let Streamlit show the traceback
+        raise
+    finally:
+        # Explicitly free heavy objects (NLP is memory hungry), the emptied contexts go back to the pool
+        for _, doc_cxt in to_parse.values():
+            doc_cxt.release()
 
-            doc_id = corpus.add_document(doc_cxt)
-            hashmap[xxhash64] = doc_id  # keep hashmap in sync
-            info(f"File {f.name} prepared and added to database with doc_id={doc_id}")
+    # -------- NLP pipeline END -------------------------------------------------------
 
-        except Exception:
-            # Any unforeseen error – let Streamlit show the traceback
-            raise
-        finally:
-            # Explicitly free heavy objects (NLP is memory hungry)
-            doc_cxt.clear()
-
-        last_filename, last_doc_id = f.name, doc_id
-
-        # -------- NLP pipeline END ---------------------------------------------------
+    # The last selected file that made it into (or already was in) the database
+    last_filename, last_doc_id = next(((filename, stored[xxhash64]) for filename, xxhash64 in reversed(uploads)
+                                       if xxhash64 in stored), ("", None))
 
     if last_doc_id is None:
         st.error("last_doc_id is None ??!")  # should never happen
@@ -156,16 +230,26 @@ if st.session_state.last_uploaded:
     last_filename, last_doc_id = st.session_state.last_uploaded
 
     lemmas_info = corpus.document_lemmas_info(last_doc_id)
-    df = pd.DataFrame(lemmas_info)
 
     # -- interactive helper: sort order ----------------------------------------------
     sort_field = st.selectbox("Выберите поле для сортировки:",
                               options=["tf-idf", "count", "tf", "idf"],
                               index=0)  # default: tf-idf
     ascending = st.checkbox("Сортировать по возрастанию значения?", value=False)
-    df = df.sort_values(by=sort_field, ascending=ascending)
+
+    # Only 50 rows are shown: partial select (O(N)) of the top rows straight on the query result,
+    # then sort just those – the DataFrame is built for 50 rows, not for the whole vocabulary
+    keys = np.fromiter(map(itemgetter(sort_field), lemmas_info), dtype=np.float64, count=len(lemmas_info))
+    if not ascending:
+        keys = -keys
+    top = min(50, len(keys))
+    rows = np.argpartition(keys, top - 1)[:top] if top else np.empty(0, dtype=np.intp)
+    rows.sort()  # back to query (tf-idf) order, so the stable sort below keeps it among ties
+    rows = rows[np.argsort(keys[rows], kind="stable")]
+
+    import pandas as pd  # heavy import, deferred until there is a table to show
 
     # Friendly 1-based index – looks nicer in a human table
-    df.index = df.index + 1
+    df = pd.DataFrame([lemmas_info[i] for i in rows], index=rows + 1)
     # Streamlit to render HTML <table>
-    st.table(df.head(50))
+    st.table(df)